@@ -5,19 +5,21 @@
 
 """
 Script para criar o índice vetorial FAISS. 
-Ele baixa os PDFs de um bucket S3 um por um para um diretório local temporário,
-processa-os com o leve PyPDFLoader e, em seguida, faz o upload do índice FAISS finalizado
+Ele lê os PDFs de um bucket S3 em paralelo direto para a memória,
+processa-os com o pypdfium2 (ou pypdf) e, em seguida, faz o upload do índice FAISS finalizado
 para outro bucket S3.
 """
 
-from langchain_aws import BedrockEmbeddings
-from langchain_community.vectorstores import FAISS
-from langchain_community.document_loaders import PyPDFLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import io
 import re
 import json
 import boto3
+from botocore.config import Config
 import os
+import threading
+
+from rag_utils import ParallelBedrockEmbeddings, build_faiss_index, extract_pdf_pages, split_texts
 
 # --- CONFIGURAÇÕES ---
 os.environ["AWS_REGION"] = "us-east-1"
@@ -25,28 +27,70 @@ VECTOR_BUCKET = "rag-ec2-vector"
 INDEX_FILE_NAME = "index-titan-sonnet"
 DOC_BUCKET = "rag-docs-juan"
 EMBED_MODEL_ID = "amazon.titan-embed-text-v2:0"
-LOCAL_PDF_DIR = "/tmp/pdf_downloads/"
 LOCAL_INDEX_PATH = "/tmp/faiss_index"
+DOWNLOAD_WORKERS = 16
+MAX_IN_FLIGHT = 2 * DOWNLOAD_WORKERS
+EMBED_WORKERS = 16
+
+# Padrões de limpeza compilados uma vez (clean_text roda para cada página)
+_RE_HYPHEN_NL = re.compile(r"-\s*\n\s*")
+_RE_MULTI_NL = re.compile(r"\n{2,}")
+_RE_MULTI_SPACE = re.compile(r"[ \t]{2,}")
+
+# Clientes boto3 não são thread-safe em todas as operações: um por thread
+_thread_local = threading.local()
 
 
 def clean_text(text: str) -> str:
     if not text:
         return text
-    text = re.sub(r"-\s*\n\s*", "", text)
-    text = re.sub(r"\n{2,}", "\n", text)
-    text = re.sub(r"[ \t]{2,}", " ", text)
+    text = _RE_HYPHEN_NL.sub("", text)
+    text = _RE_MULTI_NL.sub("\n", text)
+    text = _RE_MULTI_SPACE.sub(" ", text)
     return text.strip()
 
+def _get_s3_client():
+    client = getattr(_thread_local, "s3_client", None)
+    if client is None:
+        client = boto3.session.Session().client("s3")
+        _thread_local.s3_client = client
+    return client
+
+def download_and_parse(key: str) -> list:
+    """Lê um PDF do S3 para a memória, extrai e limpa o texto de cada página."""
+    contents = []
+    print(f"  - Processando: {key}")
+    try:
+        body = _get_s3_client().get_object(Bucket=DOC_BUCKET, Key=key)["Body"].read()
+        # Tenta pypdfium2/pypdf como primário
+        try:
+            pages = extract_pdf_pages(body)
+        except Exception:
+            # Fallback para pdfminer (importa dinamicamente para não obrigar a dependência em runtime do servidor)
+            try:
+                import pdfminer.high_level as pdfminer_high
+                pages = [pdfminer_high.extract_text(io.BytesIO(body))]
+            except Exception as e:
+                print(f"    AVISO: Falha ao extrair texto com fallback para {key}. Erro: {e}")
+                pages = []
+
+        for text in pages:
+            content = clean_text(text)
+            if content:
+                contents.append(content)
+    except Exception as e:
+        print(f"    AVISO: Falha ao processar o arquivo {key}. Erro: {e}")
+    return contents
+
 def create_and_upload_index():
     """Orquestra o download, processamento e upload do índice."""
     print("---> Iniciando a criação do índice vetorial...")
     s3_client = boto3.client("s3")
     all_docs = []
 
-    # 1. Listar e baixar PDFs do S3, processando um por um
+    # 1. Listar e baixar PDFs do S3, processando em paralelo
     print(f"[1/4] Lendo arquivos PDF do bucket: {DOC_BUCKET}")
-    os.makedirs(LOCAL_PDF_DIR, exist_ok=True)
-    
+
     try:
         paginator = s3_client.get_paginator('list_objects_v2')
         pages = paginator.paginate(Bucket=DOC_BUCKET)
@@ -60,36 +104,22 @@ def create_and_upload_index():
         return
 
     print(f"Encontrados {len(pdf_keys)} arquivos PDF. Iniciando o processamento...")
+    # Downloads são I/O-bound: processa em paralelo e limita quantos ficam em voo
+    in_flight = threading.BoundedSemaphore(MAX_IN_FLIGHT)
+    results = {}
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        futures = {}
+        for key in pdf_keys:
+            in_flight.acquire()
+            future = executor.submit(download_and_parse, key)
+            future.add_done_callback(lambda _f: in_flight.release())
+            futures[future] = key
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+
+    # Mantém a ordem original dos arquivos no bucket
     for key in pdf_keys:
-        local_pdf_path = os.path.join(LOCAL_PDF_DIR, os.path.basename(key))
-        print(f"  - Processando: {key}")
-        try:
-            s3_client.download_file(DOC_BUCKET, key, local_pdf_path)
-            # Tenta PyPDF como primário
-            try:
-                loader = PyPDFLoader(local_pdf_path)
-                docs = loader.load()
-            except Exception:
-                # Fallback para pdfminer (importa dinamicamente para não obrigar a dependência em runtime do servidor)
-                try:
-                    import pdfminer.high_level as pdfminer_high
-                    text = pdfminer_high.extract_text(local_pdf_path)
-                    docs = [ { 'page_content': clean_text(text), 'metadata': {} } ]
-                except Exception as e:
-                    print(f"    AVISO: Falha ao extrair texto com fallback para {key}. Erro: {e}")
-                    docs = []
-
-            # Normaliza e converte para o formato de Document do LangChain
-            for d in docs:
-                content = d.page_content if hasattr(d, 'page_content') else d.get('page_content', '')
-                content = clean_text(content)
-                if content:
-                    all_docs.append(content)
-        except Exception as e:
-            print(f"    AVISO: Falha ao processar o arquivo {key}. Erro: {e}")
-        finally:
-            if os.path.exists(local_pdf_path):
-                os.remove(local_pdf_path) # Limpa o arquivo temporário
+        all_docs.extend(results.get(key, []))
 
     if not all_docs:
         print("ERRO: Nenhum documento pôde ser carregado. Verifique os arquivos PDF.")
@@ -98,16 +128,23 @@ def create_and_upload_index():
     # 2. Dividir os documentos agregados
     print(f"\n[2/4] Dividindo {len(all_docs)} páginas em chunks...")
     # Heurística: chunk_size entre 300-600 tokens. Usamos caracteres como proxy.
-    splitter = RecursiveCharacterTextSplitter(chunk_size=2000, chunk_overlap=240)
-    # O splitter espera objetos Document; converte
-    doc_objs = [ { 'page_content': d, 'metadata': {} } for d in all_docs ]
-    splitted_docs = splitter.split_documents(doc_objs)
+    splitted_docs = split_texts(all_docs, chunk_size=2000, chunk_overlap=240)
     print(f"Documentos divididos em {len(splitted_docs)} chunks.")
 
     # 3. Criar o índice FAISS
-    print("\n[3/4] Criando índice FAISS com embeddings Titan...")
-    embeddings = BedrockEmbeddings(model_id=EMBED_MODEL_ID)
-    vectorstore = FAISS.from_documents(splitted_docs, embeddings)
+    print("\n[3/4] Criando índice FAISS (HNSW) com embeddings Titan...")
+    embeddings = ParallelBedrockEmbeddings(
+        model_id=EMBED_MODEL_ID,
+        normalize=True,
+        max_workers=EMBED_WORKERS,
+        # Uma conexão por thread de embedding (o pool padrão do botocore tem 10) e
+        # retries adaptativos do botocore como única camada de retry contra throttling
+        config=Config(
+            max_pool_connections=EMBED_WORKERS,
+            retries={"mode": "adaptive", "max_attempts": 6},
+        ),
+    )
+    vectorstore = build_faiss_index(splitted_docs, embeddings)
     os.makedirs(LOCAL_INDEX_PATH, exist_ok=True)
     vectorstore.save_local(LOCAL_INDEX_PATH, index_name=INDEX_FILE_NAME)
     print(f"Índice salvo localmente.")
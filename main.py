@@ -14,13 +14,18 @@ import io
 import json
 import uuid
 import time
-import shutil
+import functools
+import pickle
 import logging
-import tempfile
-from typing import List, Optional
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
 
 import boto3
+import faiss
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from cachetools import TTLCache
 
 from dotenv import load_dotenv
 from flask import Flask, request, jsonify, render_template, session
@@ -29,10 +34,9 @@ from werkzeug.utils import secure_filename
 
 # LangChain
 from langchain.chains import RetrievalQA
-from langchain_aws import BedrockEmbeddings, ChatBedrock
+from langchain.prompts import PromptTemplate
+from langchain_aws import ChatBedrock
 from langchain_community.vectorstores import FAISS
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_core.documents import Document
 from langchain_core.retrievers import BaseRetriever
 from langchain_core.callbacks import (
@@ -40,6 +44,15 @@ from langchain_core.callbacks import (
     AsyncCallbackManagerForRetrieverRun,
 )
 
+from rag_utils import (
+    HNSW_EF_SEARCH,
+    ParallelBedrockEmbeddings,
+    build_faiss_index,
+    distance_strategy_for,
+    extract_pdf_pages,
+    split_texts,
+)
+
 # ------------------------------------------------------------------------------
 # Config
 # ------------------------------------------------------------------------------
@@ -61,6 +74,19 @@ MAX_TOKENS_PER_SESSION = int(os.getenv("MAX_TOKENS_PER_SESSION", "10000"))
 MAX_OUTPUT_TOKENS = int(os.getenv("MAX_OUTPUT_TOKENS", "512"))
 CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "1000"))
 CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "150"))
+# Chamadas simultâneas ao Titan ao gerar embeddings dos chunks
+EMBED_MAX_WORKERS = int(os.getenv("EMBED_MAX_WORKERS", "16"))
+
+# Pré-aquece a conexão com o Bedrock em background na primeira requisição de cada worker
+BEDROCK_WARMUP = os.getenv("BEDROCK_WARMUP", "true").lower() in ("1", "true", "yes")
+
+# Cache em processo dos índices FAISS por sessão
+VS_CACHE_SIZE = int(os.getenv("VS_CACHE_SIZE", "128"))
+VS_CACHE_TTL = int(os.getenv("VS_CACHE_TTL", "1800"))
+# Indexações simultâneas em background (fora das threads de requisição)
+INDEX_WORKERS = int(os.getenv("INDEX_WORKERS", "2"))
+# Recall maior na primeira busca
+RETRIEVER_K = int(os.getenv("RETRIEVER_K", "6"))
 
 _missing = [k for k in ("S3_PDF_BUCKET", "S3_INDEX_BUCKET") if not os.getenv(k)]
 if _missing:
@@ -78,10 +104,54 @@ CORS(app, supports_credentials=True)
 # AWS clients
 # ------------------------------------------------------------------------------
 
-s3_client = boto3.client("s3", region_name=AWS_REGION)
-bedrock_client = boto3.client("bedrock-runtime", region_name=AWS_REGION)
+# Pool de conexões maior (uploads/downloads e embeddings em paralelo), keep-alive
+# e retries adaptativos para absorver throttling (única camada de retry: o
+# ParallelBedrockEmbeddings não repete chamadas por conta própria)
+s3_config = Config(
+    max_pool_connections=64,
+    retries={"mode": "adaptive", "max_attempts": 10},
+    tcp_keepalive=True,
+    s3={"addressing_style": "virtual"},
+)
+bedrock_config = Config(
+    max_pool_connections=max(10, EMBED_MAX_WORKERS * INDEX_WORKERS),
+    retries={"mode": "adaptive", "max_attempts": 6},
+    tcp_keepalive=True,
+)
+
+s3_client = boto3.client("s3", region_name=AWS_REGION, config=s3_config)
+bedrock_client = boto3.client("bedrock-runtime", region_name=AWS_REGION, config=bedrock_config)
+
+embeddings = ParallelBedrockEmbeddings(
+    model_id=EMBED_MODEL_ID,
+    client=bedrock_client,
+    normalize=True,
+    max_workers=EMBED_MAX_WORKERS,
+)
+
+_warmup_started = False
+_warmup_lock = threading.Lock()
+
+def _warm_up_bedrock():
+    # Abre uma conexão (DNS + TLS) com o Bedrock antes da primeira indexação real
+    try:
+        embeddings.embed_query("warmup")
+        app.logger.info("Conexão com o Bedrock aquecida.")
+    except Exception as e:
+        app.logger.warning(f"Falha no warm-up do Bedrock: {e}")
 
-embeddings = BedrockEmbeddings(model_id=EMBED_MODEL_ID, client=bedrock_client)
+@app.before_request
+def start_bedrock_warmup():
+    # Disparado na primeira requisição de cada worker (após o fork do gunicorn,
+    # mesmo com --preload), nunca no import do módulo
+    global _warmup_started
+    if not BEDROCK_WARMUP or _warmup_started:
+        return
+    with _warmup_lock:
+        if _warmup_started:
+            return
+        _warmup_started = True
+    threading.Thread(target=_warm_up_bedrock, name="bedrock-warmup", daemon=True).start()
 
 # Se usar Claude 3.7 Sonnet via inference profile, passe provider="anthropic"
 llm = ChatBedrock(
@@ -101,6 +171,16 @@ Apenas declare "não há evidência suficiente" se realmente não houver nada re
 Seja direto e cite termos do documento quando útil.
 """
 
+PROMPT = PromptTemplate(
+    input_variables=["context", "question"],
+    template=(
+        f"{SYSTEM_PROMPT}\n\n"
+        "Contexto:\n{context}\n\n"
+        "Pergunta: {question}\n\n"
+        "Resposta:"
+    ),
+)
+
 # ------------------------------------------------------------------------------
 # Utilidades S3 / sessão
 # ------------------------------------------------------------------------------
@@ -128,43 +208,102 @@ def read_status_from_s3(session_id: str) -> Optional[dict]:
     except ClientError:
         return None
 
+# Limite de chaves por chamada do delete_objects
+S3_DELETE_BATCH = 1000
+
+def _delete_prefix(bucket: str, prefix: str):
+    try:
+        paginator = s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            keys = [{"Key": item["Key"]} for item in page.get("Contents", [])]
+            for i in range(0, len(keys), S3_DELETE_BATCH):
+                resp = s3_client.delete_objects(
+                    Bucket=bucket,
+                    Delete={"Objects": keys[i:i + S3_DELETE_BATCH], "Quiet": True},
+                )
+                for err in resp.get("Errors", []):
+                    app.logger.error(f"Falha removendo s3://{bucket}/{err.get('Key')}: {err.get('Message')}")
+        app.logger.info(f"Limpeza concluída em s3://{bucket}/{prefix}")
+    except ClientError as e:
+        app.logger.error(f"Falha limpando bucket {bucket}: {e}")
+
 def cleanup_session_resources(session_id: str):
-    for bucket in (S3_PDF_BUCKET, S3_INDEX_BUCKET):
-        try:
-            paginator = s3_client.get_paginator("list_objects_v2")
-            for page in paginator.paginate(Bucket=bucket, Prefix=_session_prefix(session_id)):
-                for item in page.get("Contents", []):
-                    s3_client.delete_object(Bucket=bucket, Key=item["Key"])
-            app.logger.info(f"Limpeza concluída em s3://{bucket}/{_session_prefix(session_id)}")
-        except ClientError as e:
-            app.logger.error(f"Falha limpando bucket {bucket}: {e}")
+    invalidate_session_cache(session_id)
+    prefix = _session_prefix(session_id)
+    buckets = (S3_PDF_BUCKET, S3_INDEX_BUCKET)
+    with ThreadPoolExecutor(max_workers=len(buckets)) as executor:
+        list(executor.map(lambda bucket: _delete_prefix(bucket, prefix), buckets))
 
 # ------------------------------------------------------------------------------
 # FAISS <-> S3
 # ------------------------------------------------------------------------------
 
 def save_faiss_to_s3(vs: FAISS, session_id: str):
-    tmp_dir = tempfile.mkdtemp()
-    try:
-        vs.save_local(tmp_dir)
-        key_faiss, key_pkl = _index_keys(session_id)
-        s3_client.upload_file(os.path.join(tmp_dir, "index.faiss"), S3_INDEX_BUCKET, key_faiss)
-        s3_client.upload_file(os.path.join(tmp_dir, "index.pkl"), S3_INDEX_BUCKET, key_pkl)
-    finally:
-        shutil.rmtree(tmp_dir, ignore_errors=True)
-
-def load_faiss_from_s3(session_id: str) -> Optional[FAISS]:
-    tmp_dir = tempfile.mkdtemp()
+    # Serializa direto para memória e envia, sem passar pelo disco
+    key_faiss, key_pkl = _index_keys(session_id)
+    buf = io.BytesIO()
+    writer = faiss.PyCallbackIOWriter(buf.write)
+    faiss.write_index(vs.index, writer)
+    del writer  # descarrega o buffer interno do writer
+    buf.seek(0)
+    s3_client.upload_fileobj(buf, S3_INDEX_BUCKET, key_faiss)
+    # Mesmo formato do index.pkl gerado pelo FAISS.save_local
+    pkl = pickle.dumps((vs.docstore, vs.index_to_docstore_id))
+    s3_client.upload_fileobj(io.BytesIO(pkl), S3_INDEX_BUCKET, key_pkl)
+
+def load_faiss_from_s3(session_id: str) -> Optional[Tuple[FAISS, Tuple[str, str]]]:
+    """Baixa o índice da sessão; retorna também os ETags dos objetos lidos."""
     key_faiss, key_pkl = _index_keys(session_id)
     try:
-        s3_client.download_file(S3_INDEX_BUCKET, key_faiss, os.path.join(tmp_dir, "index.faiss"))
-        s3_client.download_file(S3_INDEX_BUCKET, key_pkl, os.path.join(tmp_dir, "index.pkl"))
-        vs = FAISS.load_local(tmp_dir, embeddings, allow_dangerous_deserialization=True)
-        return vs
+        # Lê e desserializa direto da memória, sem arquivo local
+        obj_faiss = s3_client.get_object(Bucket=S3_INDEX_BUCKET, Key=key_faiss)
+        raw = obj_faiss["Body"].read()
+        index = faiss.read_index(faiss.PyCallbackIOReader(io.BytesIO(raw).read))
+        del raw
+        if hasattr(index, "hnsw"):
+            index.hnsw.efSearch = HNSW_EF_SEARCH
+        obj_pkl = s3_client.get_object(Bucket=S3_INDEX_BUCKET, Key=key_pkl)
+        docstore, index_to_docstore_id = pickle.loads(obj_pkl["Body"].read())
     except ClientError as e:
         app.logger.error(f"Falha ao baixar índice da sessão {session_id}: {e}")
         return None
 
+    # O .faiss e o .pkl são enviados em sequência: uma leitura entre os dois
+    # uploads junta índice novo com docstore antigo
+    if index.ntotal != len(index_to_docstore_id):
+        app.logger.warning(
+            f"Índice e docstore inconsistentes na sessão {session_id} "
+            f"({index.ntotal} vetores, {len(index_to_docstore_id)} ids); ignorando."
+        )
+        return None
+
+    vs = FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=docstore,
+        index_to_docstore_id=index_to_docstore_id,
+        distance_strategy=distance_strategy_for(index),
+    )
+    return vs, (obj_faiss["ETag"], obj_pkl["ETag"])
+
+# session_id -> ((ETag do index.faiss, ETag do index.pkl), FAISS, RetrievalQA)
+_vs_cache = TTLCache(maxsize=VS_CACHE_SIZE, ttl=VS_CACHE_TTL)
+_vs_cache_lock = threading.RLock()
+
+def _index_etags(session_id: str) -> Optional[Tuple[str, str]]:
+    key_faiss, key_pkl = _index_keys(session_id)
+    try:
+        return (
+            s3_client.head_object(Bucket=S3_INDEX_BUCKET, Key=key_faiss)["ETag"],
+            s3_client.head_object(Bucket=S3_INDEX_BUCKET, Key=key_pkl)["ETag"],
+        )
+    except ClientError:
+        return None
+
+def invalidate_session_cache(session_id: str):
+    with _vs_cache_lock:
+        _vs_cache.pop(session_id, None)
+
 # ------------------------------------------------------------------------------
 # Retriever compatível (não usado por padrão, mas mantido)
 # ------------------------------------------------------------------------------
@@ -188,75 +327,89 @@ class ManualRetriever(BaseRetriever):
 # Pipelines
 # ------------------------------------------------------------------------------
 
-def build_text_chunks_from_pdf(local_pdf_path: str) -> List[Document]:
-    loader = PyPDFLoader(local_pdf_path)
-    docs = loader.load()
-    splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
-    return splitter.split_documents(docs)
+def build_text_chunks_from_pdf(data: bytes) -> List[Document]:
+    pages = [(i, text) for i, text in enumerate(extract_pdf_pages(data)) if text]
+    return split_texts(
+        [text for _, text in pages],
+        CHUNK_SIZE,
+        CHUNK_OVERLAP,
+        metadatas=[{"page": i} for i, _ in pages],
+    )
 
-def index_pdf_from_stream(file_stream: io.BytesIO, filename: str, session_id: str) -> dict:
-    safe_name = secure_filename(filename) or "documento.pdf"
-    pdf_key = f"{_session_prefix(session_id)}{uuid.uuid4()}-{safe_name}"
+def index_pdf_from_s3(pdf_key: str, session_id: str) -> dict:
+    # Única cópia do PDF em memória, lida já no worker de indexação
+    data = s3_client.get_object(Bucket=S3_PDF_BUCKET, Key=pdf_key)["Body"].read()
 
-    data = file_stream.getvalue()  # lê uma vez
+    # Parsing em memória, sem arquivo temporário
+    docs = build_text_chunks_from_pdf(data)
+    vs = build_faiss_index(docs, embeddings)
+    save_faiss_to_s3(vs, session_id)
+    return {"pdf_key": pdf_key, "chunks": len(docs)}
 
-    # Upload do PDF
-    s3_client.put_object(Bucket=S3_PDF_BUCKET, Key=pdf_key, Body=data)
-    app.logger.info(f'Arquivo {filename} enviado para s3://{S3_PDF_BUCKET}/{pdf_key}')
+def build_qa_chain(vs: FAISS) -> RetrievalQA:
+    retriever = vs.as_retriever(search_kwargs={"k": RETRIEVER_K})
+    return RetrievalQA.from_chain_type(
+        llm=llm,
+        retriever=retriever,
+        chain_type="stuff",
+        return_source_documents=False,
+        chain_type_kwargs={"prompt": PROMPT, "document_variable_name": "context"},
+    )
 
-    # Parsing local
-    with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(safe_name)[1]) as tf:
-        tf.write(data)
-        local_pdf = tf.name
+# Pool de indexação em background; o frontend acompanha o progresso via /status
+index_executor = ThreadPoolExecutor(max_workers=INDEX_WORKERS)
 
-    try:
-        docs = build_text_chunks_from_pdf(local_pdf)
-        vs = FAISS.from_documents(docs, embeddings)
-        save_faiss_to_s3(vs, session_id)
-        return {"pdf_key": pdf_key, "chunks": len(docs)}
-    finally:
+def _on_index_done(session_id: str, future):
+    invalidate_session_cache(session_id)
+    exc = future.exception()
+    if exc:
+        app.logger.error(f"Erro no processamento do upload para a sessão {session_id}: {exc}", exc_info=exc)
         try:
-            os.remove(local_pdf)
+            write_status_to_s3(session_id, "error", {"message": str(exc)})
         except Exception:
             pass
+        return
+
+    info = future.result()
+    try:
+        write_status_to_s3(session_id, "ready", info)
+    except Exception as e:
+        app.logger.warning(f"Não foi possível gravar status ready: {e}")
 
 def get_qa_chain_for_session(session_id: str) -> Optional[RetrievalQA]:
-    vs = load_faiss_from_s3(session_id)
-    if not vs:
+    """Retorna a chain da sessão do cache; só baixa o índice do S3 se algum ETag mudou."""
+    etags = _index_etags(session_id)
+    if etags is None:
+        invalidate_session_cache(session_id)
         return None
+    with _vs_cache_lock:
+        cached = _vs_cache.get(session_id)
+    if cached and cached[0] == etags:
+        return cached[2]
 
-    # Recall maior na primeira busca
-    retriever = vs.as_retriever(search_kwargs={"k": 6})
-
-    from langchain.prompts import PromptTemplate
-    prompt = PromptTemplate(
-        input_variables=["context", "question"],
-        template=(
-            f"{SYSTEM_PROMPT}\n\n"
-            "Contexto:\n{context}\n\n"
-            "Pergunta: {question}\n\n"
-            "Resposta:"
-        ),
-    )
-    chain = RetrievalQA.from_chain_type(
-        llm=llm,
-        retriever=retriever,
-        chain_type="stuff",
-        return_source_documents=False,
-        chain_type_kwargs={"prompt": prompt, "document_variable_name": "context"},
-    )
+    loaded = load_faiss_from_s3(session_id)
+    if not loaded:
+        return None
+    vs, loaded_etags = loaded
+    chain = build_qa_chain(vs)
+    # Guarda os ETags dos objetos efetivamente lidos, não os do HEAD acima
+    with _vs_cache_lock:
+        _vs_cache[session_id] = (loaded_etags, vs, chain)
     return chain
 
 # ------------------------------------------------------------------------------
 # Sessão
 # ------------------------------------------------------------------------------
 
+# Rotas que só leem a sessão (ou nem isso): não criam cookie
+_SESSIONLESS_ENDPOINTS = {"health", "status", "static"}
+
 @app.before_request
 def ensure_session():
+    if request.endpoint in _SESSIONLESS_ENDPOINTS:
+        return
     if "session_id" not in session:
         session["session_id"] = str(uuid.uuid4())
-        session["token_count"] = 0
-        session["index_ready"] = False
 
 # ------------------------------------------------------------------------------
 # Rotas
@@ -280,28 +433,29 @@ def upload():
         return jsonify({"error": "Arquivo inválido."}), 400
 
     sid = session.get("session_id")
+    safe_name = secure_filename(f.filename) or "documento.pdf"
+    pdf_key = f"{_session_prefix(sid)}{uuid.uuid4()}-{safe_name}"
     try:
-        write_status_to_s3(sid, "uploaded", {"filename": f.filename})
+        write_status_to_s3(sid, "indexing", {"filename": f.filename})
     except Exception as e:
-        app.logger.warning(f"Não foi possível gravar status uploaded: {e}")
+        app.logger.warning(f"Não foi possível gravar status indexing: {e}")
 
+    # Envia o stream do Werkzeug direto ao S3 (multipart), sem copiar o PDF para a
+    # memória; o stream é fechado ao fim da requisição, então isso não vai pro worker
     try:
-        stream = io.BytesIO(f.read())
-        info = index_pdf_from_stream(stream, f.filename, sid)
-        try:
-            write_status_to_s3(sid, "ready", {"pdf_key": info["pdf_key"]})
-        except Exception as e:
-            app.logger.warning(f"Não foi possível gravar status ready: {e}")
-
-        session["index_ready"] = True
-        return jsonify({"ok": True, "status": "ready", **info})
+        s3_client.upload_fileobj(f.stream, S3_PDF_BUCKET, pdf_key)
     except Exception as e:
-        app.logger.exception(f"Erro no processamento do upload para a sessão {sid}: {e}")
+        app.logger.exception(f"Erro no envio do upload para a sessão {sid}: {e}")
         try:
             write_status_to_s3(sid, "error", {"message": str(e)})
         except Exception:
             pass
-        return jsonify({"error": "Falha ao processar o PDF"}), 500
+        return jsonify({"error": "Falha ao enviar o PDF"}), 500
+    app.logger.info(f'Arquivo {f.filename} enviado para s3://{S3_PDF_BUCKET}/{pdf_key}')
+
+    future = index_executor.submit(index_pdf_from_s3, pdf_key, sid)
+    future.add_done_callback(functools.partial(_on_index_done, sid))
+    return jsonify({"ok": True, "status": "indexing"}), 202
 
 @app.route("/status", methods=["GET"])
 def status():
@@ -329,6 +483,8 @@ def chat():
     if status_val != "ready":
         return jsonify({"error": "Índice não está pronto. Aguarde."}), 409
 
+    # O contador vive no cookie e só é alterado aqui, então cada navegador
+    # carrega o próprio total independentemente do worker que o atende
     if session.get("token_count", 0) >= MAX_TOKENS_PER_SESSION:
         cleanup_session_resources(sid)
         session.clear()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Utilidades compartilhadas entre o servidor Flask (main.py) e o script
+de criação do índice (create_index.py).
+"""
+
+import io
+import uuid
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import List, Optional
+
+import faiss
+import numpy as np
+from langchain_aws import BedrockEmbeddings
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from pypdf import PdfReader
+
+try:
+    # Bindings do PDFium (C++): extração bem mais rápida que o pypdf puro Python
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
+try:
+    # Tokenizer em Rust: um único encode em lote no lugar do split recursivo em Python
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# O PDFium não admite chamadas simultâneas, nem em documentos diferentes
+_pdfium_lock = threading.Lock()
+
+# ------------------------------------------------------------------------------
+# PDF
+# ------------------------------------------------------------------------------
+
+def _extract_with_pdfium(data: bytes) -> List[str]:
+    with _pdfium_lock:
+        pdf = pdfium.PdfDocument(data)
+        try:
+            texts = []
+            for page in pdf:
+                textpage = page.get_textpage()
+                # O PDFium separa as linhas com \r\n; normaliza para \n como o pypdf
+                text = textpage.get_text_range() or ""
+                texts.append(text.replace("\r\n", "\n").replace("\r", "\n"))
+                textpage.close()
+                page.close()
+            return texts
+        finally:
+            pdf.close()
+
+def extract_pdf_pages(data: bytes) -> List[str]:
+    """Extrai o texto de cada página de um PDF em memória (sem passar pelo disco).
+
+    Usa o pypdfium2 quando instalado e cai para o pypdf caso contrário. As páginas
+    são lidas em sequência: nem o PdfReader nem o PDFium são thread-safe sobre o
+    mesmo documento.
+    """
+    if pdfium is not None:
+        return _extract_with_pdfium(data)
+    reader = PdfReader(io.BytesIO(data))
+    return [page.extract_text() or "" for page in reader.pages]
+
+# ------------------------------------------------------------------------------
+# Chunking
+# ------------------------------------------------------------------------------
+
+# Os tamanhos de chunk são configurados em caracteres; ~4 caracteres por token
+CHARS_PER_TOKEN = 4
+TIKTOKEN_ENCODING = "cl100k_base"
+
+@lru_cache(maxsize=1)
+def _get_encoding():
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding(TIKTOKEN_ENCODING)
+    except Exception:
+        # Sem acesso ao arquivo BPE (ex.: sem rede no primeiro uso)
+        return None
+
+def _token_windows(tokens: List[int], size: int, overlap: int) -> List[List[int]]:
+    windows = []
+    step = max(1, size - overlap)
+    start = 0
+    while start < len(tokens):
+        windows.append(tokens[start:start + size])
+        if start + size >= len(tokens):
+            break
+        start += step
+    return windows
+
+def split_texts(
+    texts: List[str],
+    chunk_size: int,
+    chunk_overlap: int,
+    metadatas: Optional[List[dict]] = None,
+) -> List[Document]:
+    """Divide textos em chunks com sobreposição (tamanhos em caracteres).
+
+    Com tiktoken, todos os textos são tokenizados numa única chamada e fatiados em
+    janelas fixas de tokens; sem ele, usa o RecursiveCharacterTextSplitter.
+    """
+    enc = _get_encoding()
+    if enc is None:
+        splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        return splitter.create_documents(texts, metadatas=metadatas)
+
+    size = max(1, chunk_size // CHARS_PER_TOKEN)
+    overlap = chunk_overlap // CHARS_PER_TOKEN
+    docs = []
+    for i, tokens in enumerate(enc.encode_ordinary_batch(texts)):
+        metadata = metadatas[i] if metadatas else {}
+        for window in _token_windows(tokens, size, overlap):
+            # Janelas podem cortar um caractere multibyte ao meio; descarta o resto
+            content = enc.decode_bytes(window).decode("utf-8", errors="ignore").strip()
+            if content:
+                docs.append(Document(page_content=content, metadata=dict(metadata)))
+    return docs
+
+# ------------------------------------------------------------------------------
+# Embeddings
+# ------------------------------------------------------------------------------
+
+class ParallelBedrockEmbeddings(BedrockEmbeddings):
+    """BedrockEmbeddings que embute vários textos em paralelo.
+
+    O Titan aceita um único texto por InvokeModel; em vez de uma chamada por vez,
+    as chamadas são distribuídas em threads e reagrupadas na ordem original.
+    O throttling fica a cargo dos retries adaptativos do client do botocore.
+    """
+
+    max_workers: int = 16
+
+    def _embed_document(self, text: str) -> List[float]:
+        # Mesmo caminho do embed_documents original: o embed_query marcaria
+        # os textos como consulta (input_type="search_query" no Cohere)
+        embedding = self._embedding_func(text)
+        if self.normalize:
+            embedding = self._normalize_vector(embedding)
+        return embedding
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(texts))) as executor:
+            return list(executor.map(self._embed_document, texts))
+
+# ------------------------------------------------------------------------------
+# FAISS
+# ------------------------------------------------------------------------------
+
+# HNSW: busca em tempo ~log(N) com recall próximo ao do IndexFlatL2
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+
+def distance_strategy_for(index) -> DistanceStrategy:
+    """Estratégia de distância do LangChain compatível com a métrica do índice FAISS."""
+    if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        return DistanceStrategy.MAX_INNER_PRODUCT
+    return DistanceStrategy.EUCLIDEAN_DISTANCE
+
+def build_faiss_index(docs: List[Document], embeddings: Embeddings) -> FAISS:
+    """Cria o vectorstore sobre um índice HNSW (FP16) em vez do IndexFlatL2 do FAISS.from_documents."""
+    if not docs:
+        raise ValueError("Nenhum texto extraído para indexar.")
+
+    # Chunks repetidos (cabeçalhos/rodapés) são embutidos uma única vez e os
+    # vetores replicados depois para cada posição
+    positions = {}
+    unique_texts = []
+    order = []
+    for d in docs:
+        digest = hashlib.sha1(d.page_content.encode("utf-8")).digest()
+        if digest not in positions:
+            positions[digest] = len(unique_texts)
+            unique_texts.append(d.page_content)
+        order.append(positions[digest])
+    # Uma única matriz float32 contígua (C-order) para um único index.add()
+    vectors = np.asarray(embeddings.embed_documents(unique_texts), dtype=np.float32, order="C")
+    if len(unique_texts) != len(docs):
+        vectors = vectors[order]
+
+    # Vetores armazenados em FP16: metade da RAM e do arquivo no S3, perda de recall desprezível.
+    # As embeddings devem ser criadas com normalize=True (vetores unitários em L2),
+    # para que o produto interno seja a similaridade de cosseno com qualquer modelo.
+    index = faiss.IndexHNSWSQ(
+        vectors.shape[1], faiss.ScalarQuantizer.QT_fp16, HNSW_M, faiss.METRIC_INNER_PRODUCT
+    )
+    index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    index.hnsw.efSearch = HNSW_EF_SEARCH
+    index.train(vectors)
+    index.add(vectors)
+
+    index_to_docstore_id = {i: str(uuid.uuid4()) for i in range(len(docs))}
+    return FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=InMemoryDocstore({index_to_docstore_id[i]: doc for i, doc in enumerate(docs)}),
+        index_to_docstore_id=index_to_docstore_id,
+        distance_strategy=distance_strategy_for(index),
+    )